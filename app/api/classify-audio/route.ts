@@ -35,8 +35,8 @@ export async function POST(request: NextRequest): Promise<Response> {
 
             for (let i = lines.length - 1; i >= 0; i--) {
               if (lines[i].startsWith("{")) {
-                const jsonLines = [lines[i]]
-                for (let j = i + 1; j < lines.length; j++) {
+                const jsonLines: string[] = []
+                for (let j = i; j < lines.length; j++) {
                   jsonLines.push(lines[j])
                   try {
                     jsonResult = JSON.parse(jsonLines.join("\n"))
@@ -7,216 +7,680 @@ import numpy as np
 import json
 import sys
 import base64
-import tempfile
+import functools
+import hashlib
+import io
 import os
+import math
+import re
+import struct
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.request
+import zipfile
 from scipy.io import wavfile
+from scipy.signal import resample_poly
 import subprocess
 
-# Check if MediaPipe is installed, if not install it
+# Check if a TFLite runtime is installed, if not install it
+try:
+    from tflite_runtime.interpreter import Interpreter, load_delegate
+except ImportError:
+    try:
+        from ai_edge_litert.interpreter import Interpreter, load_delegate
+    except ImportError:
+        print("Installing LiteRT...")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", "ai-edge-litert"])
+        from ai_edge_litert.interpreter import Interpreter, load_delegate
+
+# orjson is optional; it serializes the result payload several times faster
 try:
-    from mediapipe.tasks import python
-    from mediapipe.tasks.python.components import containers
-    from mediapipe.tasks.python import audio
+    import orjson
 except ImportError:
-    print("Installing MediaPipe...")
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "mediapipe"])
-    from mediapipe.tasks import python
-    from mediapipe.tasks.python.components import containers
-    from mediapipe.tasks.python import audio
+    orjson = None
+
+def to_json(data):
+    """Serialize results as compact single-line JSON"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(data, separators=(',', ':'))
+
+YAMNET_MODEL_URL = 'https://storage.googleapis.com/mediapipe-models/audio_classifier/yamnet/float32/1/yamnet.tflite'
+
+# The model and its ETag/digest sidecars live here
+YAMNET_CACHE_DIR = os.environ.get("YAMNET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "yamnet"))
+
+# Optional pinned SHA-256; otherwise the digest recorded at download time is checked
+YAMNET_SHA256 = os.environ.get("YAMNET_SHA256")
+
+# How long a cached model is trusted before revalidating it with the server
+MODEL_REVALIDATE_SECONDS = 24 * 60 * 60
+
+def sha256_file(path):
+    """Return the hex SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fetch_yamnet_model(model_path, etag=None):
+    """Download the model, conditionally when an ETag is known; returns False if unchanged"""
+    request = urllib.request.Request(YAMNET_MODEL_URL)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        response = urllib.request.urlopen(request, timeout=30)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+    
+    print("📥 Downloading YAMNet model...")
+    digest = hashlib.sha256()
+    # A private temp file per process, so concurrent downloads never share one
+    fd, part_path = tempfile.mkstemp(dir=os.path.dirname(model_path), suffix='.part')
+    try:
+        with response, os.fdopen(fd, 'wb') as f:
+            for block in iter(lambda: response.read(1 << 20), b''):
+                digest.update(block)
+                f.write(block)
+        
+        checksum = digest.hexdigest()
+        if YAMNET_SHA256 and checksum != YAMNET_SHA256.lower():
+            raise ValueError(f"YAMNet model checksum mismatch: got {checksum}")
+        os.replace(part_path, model_path)
+    except BaseException:
+        os.unlink(part_path)
+        raise
+    
+    # A converted model derived from the previous model is stale now
+    derived_path = f"{model_path}.int8.onnx"
+    if os.path.exists(derived_path):
+        os.unlink(derived_path)
+    
+    with open(model_path + '.sha256', 'w') as f:
+        f.write(checksum)
+    new_etag = response.headers.get('ETag')
+    if new_etag:
+        with open(model_path + '.etag', 'w') as f:
+            f.write(new_etag)
+    elif os.path.exists(model_path + '.etag'):
+        # The old ETag belongs to the replaced model and would never match again
+        os.unlink(model_path + '.etag')
+    
+    print("✅ YAMNet model downloaded successfully")
+    return True
 
 def download_yamnet_model():
-    """Download YAMNet model if not exists"""
-    model_path = 'yamnet.tflite'
-    if not os.path.exists(model_path):
-        print("📥 Downloading YAMNet model...")
-        url = 'https://storage.googleapis.com/mediapipe-models/audio_classifier/yamnet/float32/1/yamnet.tflite'
-        urllib.request.urlretrieve(url, model_path)
-        print("✅ YAMNet model downloaded successfully")
+    """Return a verified local copy of the YAMNet model, downloading it when needed"""
+    os.makedirs(YAMNET_CACHE_DIR, exist_ok=True)
+    model_path = os.path.join(YAMNET_CACHE_DIR, 'yamnet.tflite')
+    etag_path = model_path + '.etag'
+    digest_path = model_path + '.sha256'
+    
+    if not (os.path.exists(model_path) and os.path.exists(digest_path)):
+        fetch_yamnet_model(model_path)
+        return model_path
+    
+    if time.time() - os.path.getmtime(digest_path) > MODEL_REVALIDATE_SECONDS:
+        etag = None
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                etag = f.read().strip()
+        try:
+            if not fetch_yamnet_model(model_path, etag):
+                # 304 Not Modified: restart the revalidation clock
+                os.utime(digest_path)
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"⚠️ Could not revalidate YAMNet model, using cached copy: {e}")
+    
+    with open(digest_path) as f:
+        expected = (YAMNET_SHA256 or f.read()).strip().lower()
+    if sha256_file(model_path) != expected:
+        print("⚠️ Cached YAMNet model failed its checksum, downloading again...")
+        fetch_yamnet_model(model_path)
+    
     return model_path
 
+# YAMNet's native input rate; audio is resampled to it once, up front
+YAMNET_SAMPLE_RATE = 16000
+
+# YAMNet scores the waveform in fixed windows of ~0.975 seconds
+SEGMENT_SECONDS = 0.975
+
+# Top classifications kept per segment, and the minimum confidence to keep one
+MAX_RESULTS = 10
+SCORE_THRESHOLD = 0.1
+
+# Long recordings are preprocessed and classified in chunks of this many seconds
+CHUNK_SECONDS = 30
+
+# Inference backend: "tflite" (default) or "onnx" for int8-quantized ONNX Runtime
+YAMNET_BACKEND = os.environ.get("YAMNET_BACKEND", "tflite").lower()
+
+# Opt-in FP16 inference: path to an XNNPACK external delegate library, which is
+# loaded with force_fp16 so weights are packed as FP16
+XNNPACK_DELEGATE_LIBRARY = os.environ.get("YAMNET_XNNPACK_DELEGATE")
+
+# FP16 is only used if its scores stay this close to FP32 on a probe window
+FP16_SCORE_TOLERANCE = 1e-3
+
+_yamnet = None
+_yamnet_lock = threading.Lock()
+
+def load_yamnet_labels(model_path):
+    """Read the class names packed into the model's metadata"""
+    # TFLite metadata stores associated files as a zip archive appended to the model
+    with zipfile.ZipFile(model_path) as archive:
+        label_file = next(name for name in archive.namelist() if name.endswith('.txt'))
+        return [line.strip() for line in archive.read(label_file).decode('utf-8').splitlines() if line.strip()]
+
+def get_yamnet():
+    """
+    Return the shared (score_frame, window, labels, backend), loading the model once per process.
+
+    score_frame maps one window of `window` samples to a vector of class scores;
+    backend names the inference backend that was actually loaded.
+    """
+    global _yamnet
+    if _yamnet is None:
+        with _yamnet_lock:
+            if _yamnet is None:
+                model_path = download_yamnet_model()
+                scorer = None
+                if YAMNET_BACKEND == "onnx":
+                    try:
+                        scorer = create_onnx_scorer(model_path)
+                    except Exception as e:
+                        print(f"⚠️ ONNX Runtime backend unavailable, using TFLite: {e}")
+                
+                if scorer is None:
+                    interpreter = create_interpreter(model_path)
+                    backend = "YAMNet (TFLite)"
+                    if XNNPACK_DELEGATE_LIBRARY:
+                        fp16_interpreter = create_fp16_interpreter(model_path, interpreter)
+                        if fp16_interpreter is not None:
+                            interpreter, backend = fp16_interpreter, "YAMNet (TFLite, FP16 XNNPACK)"
+                    window = int(interpreter.get_input_details()[0]['shape'][-1])
+                    scorer = (functools.partial(score_frame, interpreter), window, backend)
+                
+                score, window, backend = scorer
+                _yamnet = (score, window, load_yamnet_labels(model_path), backend)
+    return _yamnet
+
+def convert_yamnet_to_int8_onnx(model_path):
+    """Convert the TFLite model to ONNX with int8 weights, once; returns the ONNX path"""
+    int8_path = f"{model_path}.int8.onnx"
+    if os.path.exists(int8_path):
+        return int8_path
+    
+    # Conversion-only dependencies
+    import tf2onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    print("🔧 Converting YAMNet to int8 ONNX...")
+    # Private temp files, so concurrent conversions never write the same path
+    cache_dir = os.path.dirname(model_path)
+    fd, fp32_path = tempfile.mkstemp(dir=cache_dir, suffix='.onnx')
+    os.close(fd)
+    fd, part_path = tempfile.mkstemp(dir=cache_dir, suffix='.int8.onnx.part')
+    os.close(fd)
+    try:
+        tf2onnx.convert.from_tflite(model_path, output_path=fp32_path)
+        quantize_dynamic(fp32_path, part_path, weight_type=QuantType.QInt8)
+        os.replace(part_path, int8_path)
+    finally:
+        for path in (fp32_path, part_path):
+            if os.path.exists(path):
+                os.unlink(path)
+    return int8_path
+
+def create_onnx_scorer(model_path):
+    """Return (score_frame, window, backend) backed by an int8 ONNX Runtime session"""
+    import onnxruntime
+    
+    session = onnxruntime.InferenceSession(
+        convert_yamnet_to_int8_onnx(model_path),
+        providers=['CPUExecutionProvider']
+    )
+    model_input = session.get_inputs()[0]
+    window = model_input.shape[-1]
+    if not isinstance(window, int):
+        window = int(SEGMENT_SECONDS * YAMNET_SAMPLE_RATE)
+    input_shape = [dim if isinstance(dim, int) else 1 for dim in model_input.shape[:-1]] + [window]
+    
+    def score(frame):
+        return session.run(None, {model_input.name: frame.reshape(input_shape)})[0].reshape(-1)
+    
+    print("⚡ YAMNet running on ONNX Runtime (int8)")
+    return score, window, "YAMNet (ONNX Runtime, int8)"
+
+def create_interpreter(model_path, delegates=None):
+    """Create a multi-threaded YAMNet interpreter with tensors allocated"""
+    interpreter = Interpreter(
+        model_path=model_path,
+        num_threads=os.cpu_count(),
+        experimental_delegates=delegates
+    )
+    interpreter.allocate_tensors()
+    return interpreter
+
+def create_fp16_interpreter(model_path, reference):
+    """Create an interpreter running XNNPACK in FP16, or None if unavailable or inaccurate"""
+    try:
+        delegate = load_delegate(XNNPACK_DELEGATE_LIBRARY, {
+            "num_threads": str(os.cpu_count()),
+            "force_fp16": "true"
+        })
+        interpreter = create_interpreter(model_path, [delegate])
+    except (ValueError, RuntimeError, OSError) as e:
+        print(f"⚠️ FP16 XNNPACK delegate unavailable, using FP32: {e}")
+        return None
+    
+    # Compare against FP32 on a fixed noise window before trusting FP16
+    window = int(reference.get_input_details()[0]['shape'][-1])
+    probe = np.random.default_rng(0).uniform(-0.5, 0.5, window).astype(np.float32)
+    drift = float(np.max(np.abs(score_frame(interpreter, probe) - score_frame(reference, probe))))
+    if drift > FP16_SCORE_TOLERANCE:
+        print(f"⚠️ FP16 scores drift by {drift:.4f}, using FP32")
+        return None
+    
+    print("⚡ YAMNet running with FP16 XNNPACK")
+    return interpreter
+
+def score_frame(interpreter, frame):
+    """Run the model on one window and return its class scores"""
+    input_detail = interpreter.get_input_details()[0]
+    output_detail = interpreter.get_output_details()[0]
+    interpreter.set_tensor(input_detail['index'], frame.reshape(input_detail['shape']))
+    interpreter.invoke()
+    return interpreter.get_tensor(output_detail['index']).reshape(-1)
+
+def run_yamnet(waveform):
+    """Score a 16 kHz mono waveform; returns a (segments, classes) score matrix"""
+    score, window, labels, _ = get_yamnet()
+    
+    # The model takes one fixed window per run; the tail is zero-padded
+    num_segments = math.ceil(len(waveform) / window)
+    frames = np.zeros((num_segments, window), dtype=np.float32)
+    frames.reshape(-1)[:len(waveform)] = waveform
+    
+    scores = np.empty((num_segments, len(labels)), dtype=np.float32)
+    for i in range(num_segments):
+        scores[i] = score(frames[i])
+    return scores
+
+def parse_wav_header(header):
+    """
+    Locate the fmt and data chunks of a little-endian integer PCM WAV.
+
+    Returns (sample_rate, channels, bits_per_sample, data_offset, data_size),
+    or None when the file needs scipy's full parser (RIFX, float, compressed...).
+    """
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', header, offset)
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or body + 16 > len(header):
+                return None
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from('<HHIIHH', header, body)
+            if format_tag != 1 or bits not in (16, 32) or channels < 1:
+                return None
+            fmt = (sample_rate, channels, bits)
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+            return fmt + (body, chunk_size)
+        # Chunks are word aligned
+        offset = body + chunk_size + (chunk_size & 1)
+    return None
+
+# Reciprocal full-scale factors for integer PCM, applied as a float32 multiply
+_INV_INT16 = np.float32(1.0 / np.iinfo(np.int16).max)
+_INV_INT32 = np.float32(1.0 / np.iinfo(np.int32).max)
+_PCM_SCALE = {np.dtype(np.int16): _INV_INT16, np.dtype(np.int32): _INV_INT32}
+
+def make_float_converter(channels, dtype):
+    """Return a function normalizing PCM chunks of this layout to float32 mono"""
+    scale = _PCM_SCALE.get(dtype)
+
+    if channels == 1:
+        if scale is None:
+            return lambda chunk: chunk.astype(np.float32, copy=False)
+
+        def convert(chunk):
+            wav_data_float = chunk.astype(np.float32)
+            np.multiply(wav_data_float, scale, out=wav_data_float)
+            return wav_data_float
+        return convert
+
+    if channels == 2:
+        # Sum the channels straight into the float32 output, then fold the
+        # 1/2 averaging into the normalization multiply
+        stereo_scale = np.float32(0.5) if scale is None else scale * np.float32(0.5)
+
+        def convert(chunk):
+            mono = np.add(chunk[:, 0], chunk[:, 1], dtype=np.float32)
+            mono *= stereo_scale
+            return mono
+        return convert
+
+    if scale is None:
+        return lambda chunk: chunk.mean(axis=1, dtype=np.float32)
+
+    def convert(chunk):
+        mono = chunk.mean(axis=1, dtype=np.float32)
+        mono *= scale
+        return mono
+    return convert
+
+@functools.lru_cache(maxsize=8)
+def make_preprocessor(sample_rate, channels, dtype):
+    """
+    Build a chunk preprocessor specialized for one (sample_rate, channels, dtype) layout.
+
+    Scale factor, channel mix and resampling ratio are resolved here once, so the
+    returned preprocess(samples, start, stop) only runs the steps that layout
+    needs: raw PCM samples[start:stop] in, 16 kHz float32 mono out. Chunks that
+    start and stop on whole seconds resample to exactly the samples a single
+    pass over the whole recording would give.
+    """
+    to_float = make_float_converter(channels, np.dtype(dtype))
+    if sample_rate == YAMNET_SAMPLE_RATE:
+        return lambda samples, start, stop: to_float(samples[start:stop])
+
+    factor = math.gcd(YAMNET_SAMPLE_RATE, int(sample_rate))
+    up, down = YAMNET_SAMPLE_RATE // factor, int(sample_rate) // factor
+    # resample_poly's filter reaches 10 * max(up, down) upsampled samples to
+    # either side; read a few times that as context around each chunk, in
+    # whole resampling periods so the chunk stays on the output sample grid
+    context = down * math.ceil(3 * 10 * max(up, down) / (up * down))
+
+    def preprocess(samples, start, stop):
+        stop = min(stop, len(samples))
+        lo, hi = max(start - context, 0), min(stop + context, len(samples))
+        resampled = resample_poly(to_float(samples[lo:hi]), up, down)
+        first = (start - lo) * up // down
+        last = None if stop == len(samples) else first + (stop - start) * up // down
+        return resampled[first:last].astype(np.float32, copy=False)
+    return preprocess
+
+def pcm_layout(bits, channels, data_size):
+    """Return the (dtype, shape) of the integer PCM samples held in data_size bytes"""
+    dtype = np.dtype('<i2') if bits == 16 else np.dtype('<i4')
+    frames = data_size // (dtype.itemsize * channels)
+    return dtype, ((frames, channels) if channels > 1 else (frames,))
+
+def decode_wav(audio_bytes):
+    """Decode in-memory WAV bytes, aliasing the PCM samples without copying when possible"""
+    header = parse_wav_header(audio_bytes)
+    if header is None:
+        return wavfile.read(io.BytesIO(audio_bytes))
+
+    sample_rate, channels, bits, data_offset, data_size = header
+    # Recorders that were cut off often leave a bogus data size behind
+    data_size = min(data_size, len(audio_bytes) - data_offset)
+    dtype, shape = pcm_layout(bits, channels, data_size)
+
+    wav_data = np.frombuffer(audio_bytes, dtype=dtype, count=math.prod(shape), offset=data_offset)
+    return sample_rate, wav_data.reshape(shape)
+
+# Bytes read from the start of a WAV file to find its fmt and data chunks
+WAV_HEADER_PROBE_BYTES = 64 * 1024
+
+def open_wav_mmap(path):
+    """Memory-map the PCM samples of a WAV file after parsing only its header"""
+    with open(path, 'rb') as f:
+        header = parse_wav_header(f.read(WAV_HEADER_PROBE_BYTES))
+        file_size = os.fstat(f.fileno()).st_size
+    if header is None:
+        try:
+            return wavfile.read(path, mmap=True)
+        except ValueError:
+            # Formats without a native dtype (e.g. 24-bit PCM) can't be mapped
+            return wavfile.read(path)
+
+    sample_rate, channels, bits, data_offset, data_size = header
+    data_size = min(data_size, file_size - data_offset)
+    dtype, shape = pcm_layout(bits, channels, data_size)
+    if shape[0] == 0:
+        # An empty mapping is not allowed
+        return sample_rate, np.zeros(shape, dtype=dtype)
+    return sample_rate, np.memmap(path, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+
+# Uploads larger than this are spooled to disk and memory-mapped instead of
+# being decoded into memory
+LARGE_UPLOAD_BYTES = 50 * 1024 * 1024
+
+def decode_base64_to_file(audio_data_base64, file, chunk_chars=4 * 1024 * 1024):
+    """Decode base64 into an open file chunk by chunk, never holding the whole payload"""
+    # Line-wrapped payloads are accepted, so whitespace is dropped before
+    # splitting; only whole 4-character base64 quanta are decoded at a time
+    pending = ''
+    for start in range(0, len(audio_data_base64), chunk_chars):
+        piece = pending + ''.join(audio_data_base64[start:start + chunk_chars].split())
+        complete = len(piece) - len(piece) % 4
+        file.write(base64.b64decode(piece[:complete]))
+        pending = piece[complete:]
+    if pending:
+        file.write(base64.b64decode(pending))
+
+def load_audio(audio_data_base64):
+    """Return (sample_rate, samples) for a base64 WAV upload"""
+    if len(audio_data_base64) * 3 // 4 <= LARGE_UPLOAD_BYTES:
+        return decode_wav(base64.b64decode(audio_data_base64))
+    
+    # Large recording: let the OS page samples in as they are read
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
+        temp_path = temp_file.name
+        decode_base64_to_file(audio_data_base64, temp_file)
+    try:
+        return open_wav_mmap(temp_path)
+    finally:
+        # The open mapping keeps the data reachable after the name is gone
+        os.unlink(temp_path)
+
 def classify_audio_with_mediapipe(audio_data_base64, filename="uploaded_audio"):
     """
-    Classify audio using MediaPipe YAMNet model
+    Classify audio using the YAMNet model
     """
     try:
         print(f"🎵 Starting MediaPipe Audio Classification: {filename}")
         
         # Decode base64 audio data
-        audio_bytes = base64.b64decode(audio_data_base64)
+        sample_rate, wav_data = load_audio(audio_data_base64)
+        print(f"📊 Audio loaded: {sample_rate} Hz, {len(wav_data)} samples")
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as temp_file:
-            temp_file.write(audio_bytes)
-            temp_path = temp_file.name
+        # Perform classification chunk by chunk, so only one chunk of float
+        # samples is alive at a time
+        _, window, labels, backend = get_yamnet()
+        chunk_samples = CHUNK_SECONDS * int(sample_rate)
+        chunk_scores = []
         
-        # Download model if needed
-        model_path = download_yamnet_model()
+        # Convert to float32, normalize, mix down to mono and resample to 16 kHz
+        channels = 1 if wav_data.ndim == 1 else wav_data.shape[1]
+        preprocess = make_preprocessor(sample_rate, channels, wav_data.dtype)
         
-        # Read audio file
-        sample_rate, wav_data = wavfile.read(temp_path)
-        print(f"📊 Audio loaded: {sample_rate} Hz, {len(wav_data)} samples")
+        # Chunks are whole seconds of input, which rarely fill whole model
+        # windows; the partial window is carried into the next chunk so the
+        # segments line up with a single pass over the recording
+        pending = np.empty(0, dtype=np.float32)
+        for start in range(0, len(wav_data), chunk_samples):
+            pending = np.concatenate((pending, preprocess(wav_data, start, start + chunk_samples)))
+            if start + chunk_samples < len(wav_data):
+                complete = len(pending) // window * window
+            else:
+                complete = len(pending)
+            chunk_scores.append(run_yamnet(pending[:complete]))
+            pending = pending[complete:]
         
-        # Convert to float and normalize
-        if wav_data.dtype == np.int16:
-            wav_data_float = wav_data.astype(float) / np.iinfo(np.int16).max
-        elif wav_data.dtype == np.int32:
-            wav_data_float = wav_data.astype(float) / np.iinfo(np.int32).max
-        else:
-            wav_data_float = wav_data.astype(float)
+        scores = np.concatenate(chunk_scores) if chunk_scores else np.empty((0, len(labels)), dtype=np.float32)
+        num_segments = len(scores)
         
-        # Handle stereo to mono conversion
-        if len(wav_data_float.shape) > 1:
-            wav_data_float = np.mean(wav_data_float, axis=1)
+        print(f"🔍 Found {num_segments} audio segments")
         
-        # Create MediaPipe audio classifier
-        base_options = python.BaseOptions(model_asset_path=model_path)
-        options = audio.AudioClassifierOptions(
-            base_options=base_options, 
-            max_results=10,  # Get top 10 classifications
-            score_threshold=0.1  # Minimum confidence threshold
-        )
+        # Process classification results: keep each segment's top classes, best
+        # first, dropping those under the confidence threshold
+        top_k = min(MAX_RESULTS, len(labels))
+        top_classes = np.argpartition(scores, -top_k, axis=1)[:, -top_k:]
+        top_scores = np.take_along_axis(scores, top_classes, axis=1)
+        best_first = np.argsort(-top_scores, axis=1, kind='stable')
+        top_classes = np.take_along_axis(top_classes, best_first, axis=1)
+        top_scores = np.take_along_axis(top_scores, best_first, axis=1)
+        kept = top_scores >= SCORE_THRESHOLD
         
-        # Perform classification
-        with audio.AudioClassifier.create_from_options(options) as classifier:
-            audio_clip = containers.AudioData.create_from_array(wav_data_float, sample_rate)
-            classification_result_list = classifier.classify(audio_clip)
-            
-            print(f"🔍 Found {len(classification_result_list)} audio segments")
-            
-            # Process classification results
-            enhanced_classifications = []
-            all_categories = {}
-            
-            for idx, classification_result in enumerate(classification_result_list):
-                timestamp_ms = idx * 975  # Each segment is ~0.975 seconds
-                timestamp_s = timestamp_ms / 1000.0
-                
-                segment_classifications = []
-                
-                if classification_result.classifications:
-                    for category in classification_result.classifications[0].categories:
-                        category_name = category.category_name
-                        confidence = category.score
-                        
-                        # Store individual segment classification
-                        segment_classifications.append({
-                            "category": category_name,
-                            "confidence": round(confidence, 4),
-                            "timestamp": round(timestamp_s, 2)
-                        })
-                        
-                        # Accumulate overall statistics
-                        if category_name not in all_categories:
-                            all_categories[category_name] = {
-                                "total_confidence": 0,
-                                "count": 0,
-                                "max_confidence": 0,
-                                "timestamps": []
-                            }
-                        
-                        all_categories[category_name]["total_confidence"] += confidence
-                        all_categories[category_name]["count"] += 1
-                        all_categories[category_name]["max_confidence"] = max(
-                            all_categories[category_name]["max_confidence"], confidence
-                        )
-                        all_categories[category_name]["timestamps"].append(timestamp_s)
-                
-                enhanced_classifications.append({
-                    "segment": idx,
-                    "timestamp": round(timestamp_s, 2),
-                    "duration": 0.975,
-                    "classifications": segment_classifications[:5]  # Top 5 per segment
-                })
-            
-            # Calculate overall statistics
-            overall_stats = []
-            for category, stats in all_categories.items():
-                avg_confidence = stats["total_confidence"] / stats["count"]
-                overall_stats.append({
-                    "category": category,
-                    "average_confidence": round(avg_confidence, 4),
-                    "max_confidence": round(stats["max_confidence"], 4),
-                    "occurrence_count": stats["count"],
-                    "coverage_percentage": round((stats["count"] / len(classification_result_list)) * 100, 1),
-                    "timestamps": stats["timestamps"][:10]  # First 10 occurrences
-                })
-            
-            # Sort by average confidence
-            overall_stats.sort(key=lambda x: x["average_confidence"], reverse=True)
-            
-            # Generate enhanced sound events based on classifications
-            enhanced_sound_events = []
-            for segment in enhanced_classifications:
-                if segment["classifications"]:
-                    top_classification = segment["classifications"][0]
-                    
-                    # Map MediaPipe categories to forensic categories
-                    forensic_category = map_to_forensic_category(top_classification["category"])
-                    
-                    enhanced_sound_events.append({
-                        "time": segment["timestamp"],
-                        "duration": segment["duration"],
-                        "type": forensic_category,
-                        "mediapipe_category": top_classification["category"],
-                        "confidence": top_classification["confidence"],
-                        "amplitude": min(top_classification["confidence"], 1.0),  # Use confidence as amplitude proxy
-                        "frequency": estimate_frequency_from_category(top_classification["category"]),
-                        "decibels": confidence_to_decibels(top_classification["confidence"]),
-                        "classification_source": "MediaPipe YAMNet"
-                    })
-            
-            # Create comprehensive analysis results
-            duration = len(wav_data_float) / sample_rate
+        # Flatten every kept (segment, class) score into parallel arrays, in segment order
+        segment_sizes = kept.sum(axis=1)
+        category_index = top_classes[kept]
+        confidences = top_scores[kept]
+        timestamps = np.repeat(np.arange(num_segments) * 975 / 1000.0, segment_sizes)  # Each segment is ~0.975 seconds
+        
+        # Per-segment outputs are sized up front and filled by index
+        enhanced_classifications = [None] * num_segments
+        segment_top_classes = top_classes[:, :5].tolist()
+        segment_top_scores = top_scores[:, :5].astype(np.float64).tolist()
+        segment_top_counts = np.minimum(segment_sizes, 5).tolist()
+        
+        for idx in range(num_segments):
+            timestamp_ms = idx * 975
+            timestamp_s = round(timestamp_ms / 1000.0, 2)
+            count = segment_top_counts[idx]
             
-            analysis_results = {
-                "filename": filename,
-                "duration": round(duration, 2),
-                "sampleRate": int(sample_rate),
-                "segments_analyzed": len(classification_result_list),
-                "segment_duration": 0.975,
-                
-                # Enhanced classifications
-                "mediapipe_classifications": {
-                    "overall_statistics": overall_stats[:15],  # Top 15 categories
-                    "segment_classifications": enhanced_classifications,
-                    "total_categories_detected": len(all_categories),
-                    "model_used": "YAMNet (MediaPipe)"
-                },
-                
-                # Enhanced sound events
-                "enhanced_sound_events": enhanced_sound_events,
-                "detectedSounds": len(enhanced_sound_events),
-                
-                # Compatibility with existing system
-                "soundEvents": enhanced_sound_events[:20],  # Top 20 for compatibility
-                "dominantFrequency": estimate_dominant_frequency(overall_stats),
-                "maxDecibels": max([event["decibels"] for event in enhanced_sound_events]) if enhanced_sound_events else -60,
-                "averageRMS": calculate_rms_from_classifications(overall_stats),
-                
-                # Analysis metadata
-                "analysisComplete": True,
-                "analysisType": "mediapipe_enhanced",
-                "timestamp": "2024-01-01T00:00:00Z",
-                "classification_confidence": "high"
+            enhanced_classifications[idx] = {
+                "segment": idx,
+                "timestamp": timestamp_s,
+                "duration": 0.975,
+                "classifications": [{
+                    "category": labels[category],
+                    "confidence": round(confidence, 4),
+                    "timestamp": timestamp_s
+                } for category, confidence in zip(segment_top_classes[idx][:count], segment_top_scores[idx][:count])]  # Top 5 per segment
             }
+        
+        # Calculate overall statistics with per-class reductions
+        num_classes = len(labels)
+        occurrence_counts = np.bincount(category_index, minlength=num_classes)
+        total_confidence = np.bincount(category_index, weights=confidences, minlength=num_classes)
+        average_confidence = total_confidence / np.maximum(occurrence_counts, 1)
+        max_confidence = np.zeros(num_classes, dtype=np.float32)
+        np.maximum.at(max_confidence, category_index, confidences)
+        
+        # Entry positions grouped by class, in segment order
+        entries_by_category = np.argsort(category_index, kind='stable')
+        group_starts = np.cumsum(occurrence_counts) - occurrence_counts
+        
+        # Sort detected classes by average confidence, ties in order of first appearance
+        detected = np.flatnonzero(occurrence_counts)
+        num_categories = len(detected)
+        first_seen = entries_by_category[group_starts[detected]]
+        ranked = detected[np.lexsort((first_seen, -np.round(average_confidence[detected], 4)))]
+        
+        # Only the top 15 categories are reported, so only they become dicts
+        overall_stats = []
+        for i in ranked[:15]:
+            start = group_starts[i]
+            count = int(occurrence_counts[i])
+            overall_stats.append({
+                "category": labels[i],
+                "average_confidence": round(float(average_confidence[i]), 4),
+                "max_confidence": round(float(max_confidence[i]), 4),
+                "occurrence_count": count,
+                "coverage_percentage": round((count / num_segments) * 100, 1),
+                "timestamps": timestamps[entries_by_category[start:start + min(count, 10)]].tolist()  # First 10 occurrences
+            })
+        
+        # Generate enhanced sound events from each segment's top classification
+        event_segments = np.flatnonzero(segment_sizes)
+        event_categories = top_classes[event_segments, 0]
+        event_confidences = np.round(top_scores[event_segments, 0].astype(np.float64), 4)
+        event_decibels = [confidence_to_decibels(confidence) for confidence in event_confidences.tolist()]
+        
+        # Frequency and forensic category only depend on the class, so they are
+        # looked up once per detected class and then gathered per event
+        category_frequencies = np.full(num_classes, 440, dtype=np.intp)
+        category_frequencies[detected] = [estimate_frequency_from_category(labels[i]) for i in detected]
+        forensic_categories = {i: map_to_forensic_category(labels[i]) for i in np.unique(event_categories).tolist()}
+        
+        enhanced_sound_events = [{
+            "time": round(segment * 975 / 1000.0, 2),
+            "duration": 0.975,
+            "type": forensic_categories[category],
+            "mediapipe_category": labels[category],
+            "confidence": confidence,
+            "amplitude": min(confidence, 1.0),  # Use confidence as amplitude proxy
+            "frequency": frequency,
+            "decibels": decibels,
+            "classification_source": "MediaPipe YAMNet"
+        } for segment, category, confidence, frequency, decibels in zip(
+            event_segments.tolist(),
+            event_categories.tolist(),
+            event_confidences.tolist(),
+            category_frequencies[event_categories].tolist(),
+            event_decibels
+        )]
+        
+        # Weight the top 5 categories' frequencies by their reported confidence and coverage
+        dominant_frequency = estimate_dominant_frequency(
+            category_frequencies[ranked[:5]].tolist(),
+            [stat["average_confidence"] * stat["coverage_percentage"] for stat in overall_stats[:5]]
+        )
+        
+        # Create comprehensive analysis results
+        duration = len(wav_data) / sample_rate
+        
+        analysis_results = {
+            "filename": filename,
+            "duration": round(duration, 2),
+            "sampleRate": int(sample_rate),
+            "segments_analyzed": num_segments,
+            "segment_duration": 0.975,
             
-            print(f"\n🎯 MediaPipe Classification Results:")
-            print(f"📁 File: {filename}")
-            print(f"⏱ Duration: {duration:.2f} seconds")
-            print(f"🔍 Segments: {len(classification_result_list)}")
-            print(f"🏷 Categories: {len(all_categories)}")
-            print(f"🎵 Sound Events: {len(enhanced_sound_events)}")
-            
-            print(f"\n🏆 Top Classifications:")
-            for i, stat in enumerate(overall_stats[:5]):
-                print(f"{i+1}. {stat['category']}: {stat['average_confidence']:.3f} confidence ({stat['coverage_percentage']:.1f}% coverage)")
+            # Enhanced classifications
+            "mediapipe_classifications": {
+                "overall_statistics": overall_stats,  # Top 15 categories
+                "segment_classifications": enhanced_classifications,
+                "total_categories_detected": num_categories,
+                "model_used": backend
+            },
             
-            # Clean up
-            os.unlink(temp_path)
+            # Enhanced sound events
+            "enhanced_sound_events": enhanced_sound_events,
+            "detectedSounds": len(enhanced_sound_events),
             
-            return json.dumps(analysis_results, indent=2)
+            # Compatibility with existing system
+            "soundEvents": enhanced_sound_events[:20],  # Top 20 for compatibility
+            "dominantFrequency": dominant_frequency,
+            "maxDecibels": max(event_decibels) if event_decibels else -60,
+            "averageRMS": calculate_rms_from_classifications([stat["average_confidence"] for stat in overall_stats[:3]]),
             
+            # Analysis metadata
+            "analysisComplete": True,
+            "analysisType": "mediapipe_enhanced",
+            "timestamp": "2024-01-01T00:00:00Z",
+            "classification_confidence": "high"
+        }
+        
+        print(f"\n🎯 MediaPipe Classification Results:")
+        print(f"📁 File: {filename}")
+        print(f"⏱ Duration: {duration:.2f} seconds")
+        print(f"🔍 Segments: {num_segments}")
+        print(f"🏷 Categories: {num_categories}")
+        print(f"🎵 Sound Events: {len(enhanced_sound_events)}")
+        
+        print(f"\n🏆 Top Classifications:")
+        for i, stat in enumerate(overall_stats[:5]):
+            print(f"{i+1}. {stat['category']}: {stat['average_confidence']:.3f} confidence ({stat['coverage_percentage']:.1f}% coverage)")
+        
+        return to_json(analysis_results)
+        
     except Exception as e:
         error_result = {
             "error": str(e),
@@ -225,118 +689,140 @@ def classify_audio_with_mediapipe(audio_data_base64, filename="uploaded_audio"):
             "message": "MediaPipe audio classification failed"
         }
         print(f"❌ MediaPipe Classification Error: {str(e)}")
-        return json.dumps(error_result, indent=2)
+        return to_json(error_result)
+
+# MediaPipe category -> forensic category
+_CATEGORY_MAPPING = {
+    # Speech and Voice
+    "Speech": "Human Voice",
+    "Male speech, man speaking": "Male Voice",
+    "Female speech, woman speaking": "Female Voice",
+    "Child speech, kid speaking": "Child Voice",
+    "Conversation": "Conversation",
+    "Narration, monologue": "Monologue",
+    "Babbling": "Infant Vocalization",
+    
+    # Music and Instruments
+    "Music": "Musical Content",
+    "Musical instrument": "Instrument",
+    "Plucked string instrument": "String Instrument",
+    "Guitar": "Guitar",
+    "Piano": "Piano",
+    "Drum kit": "Percussion",
+    "Singing": "Vocal Music",
+    
+    # Environmental Sounds
+    "Vehicle": "Vehicle Sound",
+    "Car": "Automobile",
+    "Truck": "Heavy Vehicle",
+    "Motorcycle": "Motorcycle",
+    "Aircraft": "Aircraft",
+    "Train": "Railway",
+    
+    # Mechanical and Electronic
+    "Machine": "Mechanical Sound",
+    "Motor": "Motor/Engine",
+    "Tools": "Tool Usage",
+    "Alarm": "Alert Signal",
+    "Bell": "Bell/Chime",
+    "Phone": "Telephone",
+    
+    # Nature and Animals
+    "Animal": "Animal Sound",
+    "Dog": "Canine",
+    "Cat": "Feline",
+    "Bird": "Avian",
+    "Wind": "Wind Noise",
+    "Rain": "Precipitation",
+    "Water": "Water Sound",
+    
+    # Human Activities
+    "Footsteps": "Footsteps",
+    "Door": "Door Sound",
+    "Applause": "Applause",
+    "Laughter": "Laughter",
+    "Crying": "Crying",
+    "Cough": "Cough",
+    "Sneeze": "Sneeze",
+    
+    # Background and Noise
+    "Silence": "Silence/Quiet",
+    "White noise": "Background Noise",
+    "Pink noise": "Ambient Noise",
+    "Static": "Electronic Noise",
+    "Hum": "Electrical Hum"
+}
 
+_CATEGORY_MAPPING_LOWER = {key.lower(): value for key, value in _CATEGORY_MAPPING.items()}
+
+# Keyword fallbacks, tried only when no mapping key occurs in the category
+_SPEECH_KEYWORDS = frozenset({"speech", "voice", "talk", "speak"})
+_MUSIC_KEYWORDS = frozenset({"music", "song", "instrument"})
+_VEHICLE_KEYWORDS = frozenset({"vehicle", "car", "truck", "engine"})
+_ANIMAL_KEYWORDS = frozenset({"animal", "dog", "cat", "bird"})
+_MACHINE_KEYWORDS = frozenset({"machine", "motor", "mechanical"})
+_KEYWORD_FALLBACKS = (
+    (_SPEECH_KEYWORDS, "Human Voice"),
+    (_MUSIC_KEYWORDS, "Musical Content"),
+    (_VEHICLE_KEYWORDS, "Vehicle Sound"),
+    (_ANIMAL_KEYWORDS, "Animal Sound"),
+    (_MACHINE_KEYWORDS, "Mechanical Sound"),
+)
+
+def _build_category_matcher():
+    """Compile the mapping keys and fallback keywords into one prioritized scanner"""
+    patterns = list(_CATEGORY_MAPPING_LOWER.items())
+    patterns += [(word, value) for words, value in _KEYWORD_FALLBACKS for word in sorted(words)]
+    
+    # The lookahead is zero-width, so finditer tries every start offset in a single
+    # pass; at each offset the alternation picks the highest-priority pattern, and
+    # its group number is that priority
+    alternation = "|".join(f"({re.escape(pattern)})" for pattern, _ in patterns)
+    return re.compile(f"(?=(?:{alternation}))"), [value for _, value in patterns]
+
+_CATEGORY_PATTERN, _CATEGORY_VALUES = _build_category_matcher()
+
+@functools.lru_cache(maxsize=None)
 def map_to_forensic_category(mediapipe_category):
     """Map MediaPipe categories to forensic investigation categories"""
-    category_mapping = {
-        # Speech and Voice
-        "Speech": "Human Voice",
-        "Male speech, man speaking": "Male Voice",
-        "Female speech, woman speaking": "Female Voice",
-        "Child speech, kid speaking": "Child Voice",
-        "Conversation": "Conversation",
-        "Narration, monologue": "Monologue",
-        "Babbling": "Infant Vocalization",
-        
-        # Music and Instruments
-        "Music": "Musical Content",
-        "Musical instrument": "Instrument",
-        "Plucked string instrument": "String Instrument",
-        "Guitar": "Guitar",
-        "Piano": "Piano",
-        "Drum kit": "Percussion",
-        "Singing": "Vocal Music",
-        
-        # Environmental Sounds
-        "Vehicle": "Vehicle Sound",
-        "Car": "Automobile",
-        "Truck": "Heavy Vehicle",
-        "Motorcycle": "Motorcycle",
-        "Aircraft": "Aircraft",
-        "Train": "Railway",
-        
-        # Mechanical and Electronic
-        "Machine": "Mechanical Sound",
-        "Motor": "Motor/Engine",
-        "Tools": "Tool Usage",
-        "Alarm": "Alert Signal",
-        "Bell": "Bell/Chime",
-        "Phone": "Telephone",
-        
-        # Nature and Animals
-        "Animal": "Animal Sound",
-        "Dog": "Canine",
-        "Cat": "Feline",
-        "Bird": "Avian",
-        "Wind": "Wind Noise",
-        "Rain": "Precipitation",
-        "Water": "Water Sound",
-        
-        # Human Activities
-        "Footsteps": "Footsteps",
-        "Door": "Door Sound",
-        "Applause": "Applause",
-        "Laughter": "Laughter",
-        "Crying": "Crying",
-        "Cough": "Cough",
-        "Sneeze": "Sneeze",
-        
-        # Background and Noise
-        "Silence": "Silence/Quiet",
-        "White noise": "Background Noise",
-        "Pink noise": "Ambient Noise",
-        "Static": "Electronic Noise",
-        "Hum": "Electrical Hum"
-    }
-    
     # Check for exact matches first
-    if mediapipe_category in category_mapping:
-        return category_mapping[mediapipe_category]
+    if mediapipe_category in _CATEGORY_MAPPING:
+        return _CATEGORY_MAPPING[mediapipe_category]
     
-    # Check for partial matches
-    for key, value in category_mapping.items():
-        if key.lower() in mediapipe_category.lower():
-            return value
+    # Partial matches and keyword fallbacks, in the order they are listed
+    best = min((match.lastindex for match in _CATEGORY_PATTERN.finditer(mediapipe_category.lower())), default=None)
+    if best is not None:
+        return _CATEGORY_VALUES[best - 1]
     
-    # Default categorization based on keywords
-    category_lower = mediapipe_category.lower()
-    if any(word in category_lower for word in ["speech", "voice", "talk", "speak"]):
-        return "Human Voice"
-    elif any(word in category_lower for word in ["music", "song", "instrument"]):
-        return "Musical Content"
-    elif any(word in category_lower for word in ["vehicle", "car", "truck", "engine"]):
-        return "Vehicle Sound"
-    elif any(word in category_lower for word in ["animal", "dog", "cat", "bird"]):
-        return "Animal Sound"
-    elif any(word in category_lower for word in ["machine", "motor", "mechanical"]):
-        return "Mechanical Sound"
-    else:
-        return f"Other: {mediapipe_category}"
+    return f"Other: {mediapipe_category}"
+
+# Sound category keyword -> typical frequency (Hz), checked in this order
+_FREQUENCY_ESTIMATES = {
+    "Speech": 300,
+    "Male speech": 150,
+    "Female speech": 250,
+    "Child speech": 400,
+    "Music": 440,
+    "Piano": 440,
+    "Guitar": 330,
+    "Drum": 100,
+    "Bell": 1000,
+    "Bird": 2000,
+    "Dog": 500,
+    "Cat": 800,
+    "Vehicle": 200,
+    "Machine": 150,
+    "Wind": 50,
+    "Water": 300
+}
+_FREQUENCY_ESTIMATES_LOWER = tuple((key.lower(), freq) for key, freq in _FREQUENCY_ESTIMATES.items())
 
+@functools.lru_cache(maxsize=None)
 def estimate_frequency_from_category(category):
     """Estimate frequency range based on sound category"""
-    frequency_estimates = {
-        "Speech": 300,
-        "Male speech": 150,
-        "Female speech": 250,
-        "Child speech": 400,
-        "Music": 440,
-        "Piano": 440,
-        "Guitar": 330,
-        "Drum": 100,
-        "Bell": 1000,
-        "Bird": 2000,
-        "Dog": 500,
-        "Cat": 800,
-        "Vehicle": 200,
-        "Machine": 150,
-        "Wind": 50,
-        "Water": 300
-    }
-    
-    for key, freq in frequency_estimates.items():
-        if key.lower() in category.lower():
+    category_lower = category.lower()
+    for key, freq in _FREQUENCY_ESTIMATES_LOWER:
+        if key in category_lower:
             return freq
     
     return 440  # Default A4 note
@@ -348,31 +834,20 @@ def confidence_to_decibels(confidence):
     # Map confidence (0-1) to decibel range (-60 to 0)
     return round(-60 + (confidence * 60), 1)
 
-def estimate_dominant_frequency(overall_stats):
-    """Estimate dominant frequency from classification statistics"""
-    if not overall_stats:
+def estimate_dominant_frequency(frequencies, weights):
+    """Estimate dominant frequency as the weighted average of category frequencies"""
+    total_weight = sum(weights)
+    if total_weight <= 0:
         return 440
-    
-    # Weight frequencies by confidence and coverage
-    weighted_freq = 0
-    total_weight = 0
-    
-    for stat in overall_stats[:5]:  # Top 5 categories
-        freq = estimate_frequency_from_category(stat["category"])
-        weight = stat["average_confidence"] * stat["coverage_percentage"]
-        weighted_freq += freq * weight
-        total_weight += weight
-    
-    return round(weighted_freq / total_weight if total_weight > 0 else 440, 1)
+    return round(sum(freq * weight for freq, weight in zip(frequencies, weights)) / total_weight, 1)
 
-def calculate_rms_from_classifications(overall_stats):
-    """Calculate approximate RMS from classification confidence"""
-    if not overall_stats:
+def calculate_rms_from_classifications(top_confidences):
+    """Calculate approximate RMS from the top categories' average confidences"""
+    if len(top_confidences) == 0:
         return 0.01
     
     # Use average confidence of top categories as RMS proxy
-    top_confidences = [stat["average_confidence"] for stat in overall_stats[:3]]
-    avg_confidence = sum(top_confidences) / len(top_confidences)
+    avg_confidence = float(np.mean(top_confidences))
     
     # Scale to typical RMS range
     return round(avg_confidence * 0.1, 6)